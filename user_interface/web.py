@@ -1,8 +1,11 @@
 
-import os
-import json
-import tempfile
+import asyncio
+import datetime
+import uuid
+import aiohttp
 import boto3
+import orjson
+from botocore.config import Config
 from typing import Optional
 from aiohttp import web
 from aiohttp.web_request import Request
@@ -10,6 +13,47 @@ import dotenv
 
 dotenv.load_dotenv()
 
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, Authorization",
+}
+
+_s3_client = None
+_api_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_s3_client():
+    """Return a process-wide S3 client, created on first use"""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client(
+            "s3",
+            config=Config(max_pool_connections=32, retries={"mode": "adaptive", "max_attempts": 5}, tcp_keepalive=True),
+        )
+    return _s3_client
+
+
+def get_api_session() -> aiohttp.ClientSession:
+    """Return a keep-alive session for inference API calls, created on first use"""
+    global _api_session
+    if _api_session is None or _api_session.closed:
+        _api_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, keepalive_timeout=75, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+    return _api_session
+
+
+def json_response(payload, status: int = 200) -> web.Response:
+    """web.json_response serialized with orjson"""
+    return web.Response(body=orjson.dumps(payload), status=status, content_type="application/json")
+
+
+async def close_api_session(app):
+    if _api_session is not None:
+        await _api_session.close()
+
         
 def routes():
     """Define the web routes for the ComfyUI extension"""
@@ -22,97 +66,87 @@ def routes():
 async def save_workflow(request: Request) -> web.Response:
     """Save workflow JSONs directly to S3 and update workflow node"""
     try:
-        data = await request.json()
+        data = orjson.loads(await request.read())
         workflow_dict = data.get("workflow")
         workflow_node_id = data.get("workflow_node_id")
         movie_id = data.get("movie_id")
         
         if not workflow_dict or "nonapi" not in workflow_dict or "api" not in workflow_dict:
-            return web.json_response({
+            return json_response({
                 "success": False,
                 "message": "Invalid workflow format. Expected workflow: {nonapi: ..., api: ...}"
             }, status=400)
         
         if not workflow_node_id or not movie_id:
-            return web.json_response({
+            return json_response({
                 "success": False,
                 "message": "Missing required parameters: workflow_node_id and movie_id"
             }, status=400)
         
-        # Initialize S3 client
-        s3_client = boto3.client('s3')
+        s3_client = get_s3_client()
         s3_bucket = "obobo-media-production"
         s3_prefix = "workflows"
         
-        # Create temporary files for both workflows
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as nonapi_file:
-            json.dump(workflow_dict["nonapi"], nonapi_file, indent=2)
-            nonapi_temp_path = nonapi_file.name
+        # Serialize each workflow once, straight into the upload body; no temp files on disk
+        nonapi_body = orjson.dumps(workflow_dict["nonapi"], option=orjson.OPT_INDENT_2)
+        api_body = orjson.dumps(workflow_dict["api"], option=orjson.OPT_INDENT_2)
+
+        # Generate unique filenames
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        unique_id = str(uuid.uuid4())[:8]
         
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as api_file:
-            json.dump(workflow_dict["api"], api_file, indent=2)
-            api_temp_path = api_file.name
+        nonapi_filename = f"workflow_{timestamp}_{unique_id}.json"
+        api_filename = f"workflow_api_{timestamp}_{unique_id}.json"
         
-        try:
-            # Generate unique filenames
-            import uuid
-            import datetime
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_id = str(uuid.uuid4())[:8]
-            
-            nonapi_filename = f"workflow_{timestamp}_{unique_id}.json"
-            api_filename = f"workflow_api_{timestamp}_{unique_id}.json"
-            
-            
-            # Upload both files to S3
-            s3_client.upload_file(
-                nonapi_temp_path,
-                s3_bucket,
-                f"{s3_prefix}/{movie_id}/{nonapi_filename}",
-            )
-            nonapi_s3_url = f"https://media.obobo.net/{s3_prefix}/{movie_id}/{nonapi_filename}"
-            
-            s3_client.upload_file(
-                api_temp_path,
-                s3_bucket,
-                f"{s3_prefix}/{movie_id}/{api_filename}",
-            )
-            api_s3_url = f"https://media.obobo.net/{s3_prefix}/{movie_id}/{api_filename}"
-            
-            # Update the workflow node with new URLs via inference API
-            import aiohttp
-            # inference_api_url = os.getenv('LOCAL_INFERENCE_API_URL', 'http://inference.obobo.net')
-            inference_api_url = "http://inference.obobo.net"
-            update_url = f"{inference_api_url}/v1/worker/workflow-node/{workflow_node_id}/update-workflow"
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.post(update_url, json={
-                    "workflow": {
-                        "link": nonapi_s3_url,
-                        "api_link": api_s3_url,
-                    }
-                }) as response:
-                    if response.status == 200:
-                        return web.json_response({
-                            "success": True,
-                            "message": "Workflows saved successfully",
-                            "url": nonapi_s3_url,
-                            "api_url": api_s3_url
-                        })
-                    else:
-                        error_text = await response.text()
-                        return web.json_response({
-                            "success": False,
-                            "message": f"Failed to update workflow node: {error_text}"
-                        }, status=response.status)
         
-        finally:
-            # Clean up temporary files
-            os.unlink(nonapi_temp_path)
-            os.unlink(api_temp_path)
+        # Upload both files to S3 concurrently; boto3 blocks, so keep it off ComfyUI's event loop
+        await asyncio.gather(
+            asyncio.to_thread(
+                s3_client.put_object,
+                Bucket=s3_bucket,
+                Key=f"{s3_prefix}/{movie_id}/{nonapi_filename}",
+                Body=nonapi_body,
+                ContentType="application/json",
+            ),
+            asyncio.to_thread(
+                s3_client.put_object,
+                Bucket=s3_bucket,
+                Key=f"{s3_prefix}/{movie_id}/{api_filename}",
+                Body=api_body,
+                ContentType="application/json",
+            ),
+        )
+        nonapi_s3_url = f"https://media.obobo.net/{s3_prefix}/{movie_id}/{nonapi_filename}"
+        api_s3_url = f"https://media.obobo.net/{s3_prefix}/{movie_id}/{api_filename}"
+        
+        # Update the workflow node with new URLs via inference API
+        # inference_api_url = os.getenv('LOCAL_INFERENCE_API_URL', 'http://inference.obobo.net')
+        inference_api_url = "http://inference.obobo.net"
+        update_url = f"{inference_api_url}/v1/worker/workflow-node/{workflow_node_id}/update-workflow"
+        
+        session = get_api_session()
+        async with session.post(update_url, data=orjson.dumps({
+            "workflow": {
+                "link": nonapi_s3_url,
+                "api_link": api_s3_url,
+            }
+        }), headers={"Content-Type": "application/json"}) as response:
+            if response.status == 200:
+                return json_response({
+                    "success": True,
+                    "message": "Workflows saved successfully",
+                    "url": nonapi_s3_url,
+                    "api_url": api_s3_url
+                })
+            else:
+                error_text = await response.text()
+                return json_response({
+                    "success": False,
+                    "message": f"Failed to update workflow node: {error_text}"
+                }, status=response.status)
                     
     except Exception as e:
-        return web.json_response({
+        return json_response({
             "success": False,
             "message": str(e)
         }, status=500)
@@ -120,16 +154,21 @@ async def save_workflow(request: Request) -> web.Response:
 # Required by ComfyUI
 @web.middleware
 async def cors_handler(request, handler):
-    """Handle CORS for API requests"""
+    """Handle CORS for the obobo API routes; ComfyUI's own routes pass through untouched"""
+    if not request.path.startswith("/api/obobo/"):
+        return await handler(request)
+    # Answer preflight requests directly instead of running the handler
+    if request.method == "OPTIONS":
+        return web.Response(status=204, headers=CORS_HEADERS)
     response = await handler(request)
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    response.headers.update(CORS_HEADERS)
     return response
 
 # ComfyUI web extension setup
 from server import PromptServer
 
+PromptServer.instance.app.on_cleanup.append(close_api_session)
+
 @PromptServer.instance.routes.post("/api/obobo/save_workflow")
 async def save_workflow_route(request):
     return await save_workflow(request)
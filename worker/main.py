@@ -1,23 +1,55 @@
 import argparse
 import asyncio
+import hashlib
 import logging
-import sys
+import random
+import signal
 import time
-import json
-import re
-from datetime import datetime
-from typing import Optional, Dict, Any
-import requests
+import traceback
+import uuid
+from urllib.parse import urlsplit
+from typing import Optional, Dict, Any, List, Tuple
+import aiohttp
+import orjson
+# Faster event loop when installed; the worker runs fine on the default asyncio loop without it
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+from requests import HTTPError
 import os
-from utils.device import get_gpu_info
-from utils.database import get_s3_client
-from utils.comfyui import queue_claimed_jobs, jobs_in_comfyui_queue, check_completed_jobs_and_get_outputs, upload_completed_jobs, unload_models_and_empty_memory
+from utils.device import get_cached_gpu_info, get_gpu_utilization
+from utils.database import get_s3_transfer
+from utils.state import JobStateStore
+from utils.comfyui import QueuedJob, fetch_workflow, queue_claimed_jobs, comfyui_knows_prompt, check_completed_jobs_and_get_outputs, upload_completed_job, handle_generation_error, unload_models_and_empty_memory
 
 # example usage for local develpopment
 # CUDA_VISIBLE_DEVICES=0 python worker/main.py --api-url http://localhost:8001 --comfyui_server http://127.0.0.1:8188 --worker_id test-worker --batch "{}"
 # CUDA_VISIBLE_DEVICES=0 python worker/main.py --api-url https://inference.obobo.net --comfyui_server http://127.0.0.1:8188 --worker_id test-worker --batch "{}"
 
+# Performance note: the worker does no numeric work of its own. Its time goes to HTTP calls to the
+# API and ComfyUI, S3 uploads and small file writes, so optimizations belong in connection reuse,
+# fewer round trips and overlapping I/O, not in SIMD or GPU code.
+
 COMFYUI_PATH = "../../.."
+# ComfyUI websocket events that can mean a queued job finished; "executing" only counts when node is None.
+# "status" is broadcast to every socket on each queue change, the others only reach the prompt's client_id
+COMFYUI_WAKE_EVENTS = ("status", "executing", "execution_success", "execution_error", "execution_interrupted")
+# Without the websocket, poll quickly right after a job finishes and back off while nothing changes
+MIN_COMFYUI_POLL_INTERVAL = 0.5
+MAX_COMFYUI_POLL_INTERVAL = 5
+# The API may hold the batch request open this long until work arrives
+BATCH_LONG_POLL_SECONDS = 30
+# Background heartbeat cadence, also the most often GPU utilization is sampled
+HEARTBEAT_INTERVAL = 5
+# A batch that has not finished generating by then is abandoned
+MAX_BATCH_PROCESSING_TIME = 3600
+MIN_POLL_DELAY = 1.0
+MAX_POLL_DELAY = 30.0
+S3_BUCKET = "obobo-media-production"
+S3_PREFIX = "movies"
 
 # Configure logging
 logging.basicConfig(
@@ -27,47 +59,115 @@ logger = logging.getLogger(__name__)
 
 
 class Worker:
-    def __init__(self, api_url: str, worker_id: str, batch: Optional[str] = None, comfyui_server: Optional[str] = None, idle_timeout: int = 300, shutdown_machine: bool = False, instance_id: Optional[str] = None, tunnel_url: Optional[str] = None):
+    def __init__(self, api_url: str, worker_id: str, batch: Optional[str] = None, comfyui_server: Optional[str] = None, idle_timeout: int = 300, shutdown_machine: bool = False, instance_id: Optional[str] = None, tunnel_url: Optional[str] = None, upload_concurrency: int = 8, upload_mode: str = "s3", max_batches_per_poll: int = 1):
         self.api_url = api_url.rstrip("/")
         self.worker_id = worker_id
         self.registered = False
-        self.gpus = get_gpu_info()
+        self.instance_id = instance_id
+        self.gpus = get_cached_gpu_info(instance_id)
         self.batch = batch
         self.comfyui_server = comfyui_server
+        self.comfyui_port = urlsplit(comfyui_server or "").port or 8188
         # Tunnel URL is provided by the parent script
         self.tunnel_url = tunnel_url
-        self.s3_client = get_s3_client()
+        # GPUs and tunnel don't change during the worker's lifetime, so serialize once for every registration attempt
+        self.register_payload = orjson.dumps({
+            "gpus": [g.model_dump() for g in self.gpus],
+            "port_address": str(self.comfyui_port),
+            "tunnel_url": self.tunnel_url,
+            "instance_id": self.instance_id,
+        })
+        # In presigned mode the API signs each upload and the worker needs no AWS credentials
+        self.s3_transfer = get_s3_transfer(parallel_uploads=upload_concurrency) if upload_mode == "s3" else None
+        # Bounded concurrent S3 uploads; the limit halves when S3 keeps throttling and grows back by one per upload
+        self.upload_concurrency = upload_concurrency
+        self.upload_limit = upload_concurrency
+        self.upload_slots = asyncio.Condition()
+        self.in_flight_uploads = 0
+        # Jobs still generating in ComfyUI, per batch, reported in heartbeats
+        self.active_batches: Dict[str, int] = {}
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        # Uploads still draining for batches that finished generating
+        self.upload_tasks: set = set()
         self.comfyui_output_path = f"{COMFYUI_PATH}/output"
         self.last_workflow_url = None
-        self.batch_wait_time = 15
+        self.last_workflow_hash = None
+        self.last_workflow_content: Optional[bytes] = None
+        # Concurrent batches share one ComfyUI, so only one at a time may unload models and queue
+        self.queue_lock = asyncio.Lock()
+        # Per-job progress survives restarts so interrupted batches can be resumed
+        self.job_state = JobStateStore(f"tmp/worker_state_{worker_id}.sqlite")
+        # Consecutive loop failures, drives the error backoff in run_continuous
+        self.consecutive_failures = 0
+        # Idle polling delay, grows while no batches arrive and resets when one does
+        self.poll_delay = MIN_POLL_DELAY
+        # Each worker drives a single ComfyUI on its own GPU, so claim one batch at a time unless told otherwise
+        self.max_batches_per_poll = max(1, max_batches_per_poll)
         # Add auto-shutdown tracking
-        self.last_job_time = time.time()
+        self.last_job_time = time.monotonic()
         self.max_idle_time = idle_timeout  # Use provided timeout
         self.should_shutdown = False
         self.shutdown_machine = shutdown_machine
-        self.instance_id = instance_id
         self.idle_flag_written = False
-
-    def test_comfyui_connectivity(self) -> bool:
+        self.last_idle_log_time = 0.0
+        # Set by SIGTERM/SIGINT; the poll loop stops claiming batches once it is set
+        self.stop_event = asyncio.Event()
+        # Shared keep-alive HTTP session, created in run() once the event loop is running
+        self.http: Optional[aiohttp.ClientSession] = None
+
+    def create_http_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=64, limit_per_host=32),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+
+    async def request_api(self, method: str, url: str, max_attempts: int = 5, **kwargs) -> Tuple[int, bytes]:
+        """
+        Send a request to the API and return (status, body).
+        Network errors and 5xx responses are retried with jittered exponential backoff
+        (0.25s up to 4s); 4xx responses raise ClientResponseError immediately.
+        """
+        for attempt in range(max_attempts):
+            try:
+                async with self.http.request(method, url, **kwargs) as response:
+                    body = await response.read()
+                    if response.status < 500:
+                        response.raise_for_status()
+                        return response.status, body
+                    error = aiohttp.ClientResponseError(
+                        response.request_info,
+                        response.history,
+                        status=response.status,
+                        message=response.reason or "",
+                    )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt == max_attempts - 1:
+                raise error
+            delay = min(0.25 * 2 ** attempt, 4) * random.uniform(0.5, 1.5)
+            logger.warning(f"{method} {url} failed ({error!r}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def test_comfyui_connectivity(self) -> bool:
         """Test if ComfyUI is responding and ready"""
         try:
             # Use the /prompt endpoint which returns queue info - this is a real ComfyUI endpoint
-            response = requests.get(f"{self.comfyui_server}/prompt", timeout=5)
-            if response.status_code == 200:
-                # Check if the response has the expected structure
-                data = response.json()
-                return "exec_info" in data
-            return False
+            async with self.http.get(f"{self.comfyui_server}/prompt", timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status == 200:
+                    # Check if the response has the expected structure
+                    data = orjson.loads(await response.read())
+                    return "exec_info" in data
+                return False
         except Exception as e:
             logger.debug(f"ComfyUI not ready yet: {e}")
             return False
 
-    def register(self) -> bool:
+    async def register(self) -> bool:
         """Register worker with the API"""
         try:
             # First, ensure ComfyUI is ready
             logger.info("Checking ComfyUI connectivity before registration...")
-            if not self.test_comfyui_connectivity():
+            if not await self.test_comfyui_connectivity():
                 logger.info("ComfyUI not ready yet, will retry registration later")
                 return False
 
@@ -76,26 +176,18 @@ class Worker:
                 logger.info(f"Using tunnel URL: {self.tunnel_url}")
             else:
                 logger.info("No tunnel URL provided")
-        
-            import re
-            port_match = re.search(r':(\d+)', self.comfyui_server)
-            comfyui_port = int(port_match.group(1)) if port_match else 8188
-            
+
             logger.info("ComfyUI is ready, registering worker...")
             if self.instance_id:
                 logger.info(f"Registering worker with instance ID: {self.instance_id}")
-            response = requests.post(
+            await self.request_api(
+                "POST",
                 f"{self.api_url}/v1/worker/register/{self.worker_id}",
-                json={
-                    "gpus": [g.model_dump() for g in self.gpus],
-                    "port_address": str(comfyui_port),
-                    "tunnel_url": self.tunnel_url,
-                    "instance_id": self.instance_id,
-                    
-                    },
+                data=self.register_payload,
+                headers={"Content-Type": "application/json"},
             )
-            response.raise_for_status()
             self.registered = True
+            self.start_heartbeat()
             
             if self.tunnel_url:
                 logger.info(f"Successfully registered and activated worker {self.worker_id} with tunnel: {self.tunnel_url}")
@@ -107,21 +199,65 @@ class Worker:
             logger.error(f"Failed to register worker: {e}")
             return False
 
-    def send_heartbeat(self) -> bool:
+    async def send_heartbeat(self, metrics: Optional[Dict[str, Any]] = None) -> bool:
         """Send heartbeat to API to indicate worker is still alive"""
         try:
-            response = requests.post(f"{self.api_url}/v1/worker/heartbeat/{self.worker_id}")
-            response.raise_for_status()
+            await self.request_api(
+                "POST",
+                f"{self.api_url}/v1/worker/heartbeat/{self.worker_id}",
+                max_attempts=1,
+                data=orjson.dumps(metrics) if metrics is not None else None,
+                headers={"Content-Type": "application/json"} if metrics is not None else None,
+            )
             return True
+        except aiohttp.ClientResponseError as e:
+            logger.error(f"Failed to send heartbeat: {e}")
+            # The API no longer knows this worker, register again
+            if e.status in (401, 403, 404):
+                self.registered = False
+            return False
         except Exception as e:
             logger.error(f"Failed to send heartbeat: {e}")
             return False
 
-    def unregister(self) -> bool:
+    def start_heartbeat(self):
+        """Start the background heartbeat, replacing one left from a previous registration"""
+        self.stop_heartbeat()
+        self.heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+
+    def stop_heartbeat(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    async def heartbeat_loop(self):
+        """Report liveness and progress every HEARTBEAT_INTERVAL seconds, independent of batch processing"""
+        while True:
+            try:
+                gpu_util = await asyncio.to_thread(get_gpu_utilization)
+            except Exception as e:
+                logger.debug(f"Could not read GPU utilization: {e}")
+                gpu_util = []
+            metrics = {
+                "worker_id": self.worker_id,
+                "gpu_util": gpu_util,
+                "queue_depth": sum(self.active_batches.values()),
+                "in_flight_uploads": self.in_flight_uploads,
+                "current_batch_ids": list(self.active_batches),
+            }
+            if not await self.send_heartbeat(metrics):
+                if not self.registered:
+                    # run_continuous registers again, which starts a new heartbeat
+                    logger.warning("Worker is no longer registered, stopping heartbeat")
+                    return
+                logger.warning("Failed to send heartbeat, will retry on the next interval")
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def unregister(self) -> bool:
         """Unregister worker from API"""
+        self.stop_heartbeat()
         try:
-            response = requests.delete(f"{self.api_url}/v1/worker/{self.worker_id}")
-            response.raise_for_status()
+            await self.request_api("DELETE", f"{self.api_url}/v1/worker/{self.worker_id}")
             self.registered = False
             logger.info(f"Successfully unregistered worker {self.worker_id}")
             
@@ -130,87 +266,313 @@ class Worker:
             logger.error(f"Failed to unregister worker: {e}")
             return False
 
-    def get_next_batch(self) -> Optional[Dict[str, Any]]:
-        """Get next batch from API"""
+    async def get_next_batches(self, max_batches: int = 1) -> List[Dict[str, Any]]:
+        """Get up to max_batches batches from API in a single request"""
         try:
-            response = requests.get(
-                f"{self.api_url}/v1/inference/batch/{self.worker_id}"
+            status, body = await self.request_api(
+                "GET",
+                f"{self.api_url}/v1/inference/batch/{self.worker_id}",
+                params={"max": max_batches, "wait": BATCH_LONG_POLL_SECONDS},
+                timeout=aiohttp.ClientTimeout(total=BATCH_LONG_POLL_SECONDS + 5),
             )
-            # if status is 204, return None
-            if response.status_code == 204:
-                return None
-            else:
-                return response.json()
+            # if status is 204, there is no work available
+            if status == 204:
+                return []
+            data = orjson.loads(body)
+            # older API versions return a single batch object
+            if isinstance(data, dict):
+                return [data]
+            return [batch for batch in data if batch]
+        except aiohttp.ClientResponseError as e:
+            logger.error(f"Error getting next batch: {e}")
+            # The API no longer knows this worker, register again
+            if e.status in (401, 403, 404):
+                self.registered = False
+            return []
         except Exception as e:
             logger.error(f"Error getting next batch: {e}")
-            self.registered = False
-            return None
+            return []
 
     async def process_batch(self, batch: Dict[str, Any]) -> bool:
         """
         Process a batch of work.
         This is a dummy implementation - replace with actual processing logic.
         """
-        max_batch_processing_time = 3600
-        start_time = time.time()
-        last_heartbeat_time = time.time()
-        heartbeat_interval = 30  # Send heartbeat every 30 seconds during processing
-        
-        if self.last_workflow_url != batch["workflow_url"]:
-            unload_models_and_empty_memory(self.comfyui_server)
+        workflows = {}
+        if batch["workflow_url"] == self.last_workflow_url and self.last_workflow_content is not None:
+            # Same workflow as the last batch, no need to download it again
+            workflows[batch["workflow_url"]] = self.last_workflow_content
+            workflow_hash = self.last_workflow_hash
+        else:
+            # Compare workflow contents, not URLs, so a re-hosted workflow keeps its models loaded
+            try:
+                workflow_content = await asyncio.to_thread(fetch_workflow, batch["workflow_url"])
+                workflows[batch["workflow_url"]] = workflow_content
+                workflow_hash = hashlib.blake2b(workflow_content, digest_size=16).hexdigest()
+            except Exception as e:
+                logger.warning(f"Failed to fetch workflow {batch['workflow_url']}, comparing by URL: {e}")
+                workflow_hash = None
+        async with self.queue_lock:
+            if workflow_hash is not None:
+                workflow_changed = workflow_hash != self.last_workflow_hash
+            else:
+                workflow_changed = batch["workflow_url"] != self.last_workflow_url
+            if workflow_changed:
+                await asyncio.to_thread(unload_models_and_empty_memory, self.comfyui_server)
             self.last_workflow_url = batch["workflow_url"]
-        queued_jobs = queue_claimed_jobs(
-                batch["generations"],
+            self.last_workflow_hash = workflow_hash
+            self.last_workflow_content = workflows.get(batch["workflow_url"])
+            # Subscribe before queueing so no completion event is missed, and queue under the socket's
+            # clientId: ComfyUI sends a prompt's executing/execution_* events only to that client
+            client_id = self.new_comfyui_client_id()
+            ws = await self.connect_comfyui_events(client_id)
+            queued_jobs = await self.queue_jobs(batch["generations"], workflows, client_id=client_id)
+        return await self.complete_queued_jobs(queued_jobs, ws, batch_id=str(batch.get("_id") or uuid.uuid4().hex[:8]), client_id=client_id)
+
+    async def process_batches(self, batches: List[Dict[str, Any]]):
+        """Process batches concurrently; if one fails the others are cancelled instead of left running unsupervised"""
+        tasks = [asyncio.create_task(self.process_batch(batch)) for batch in batches]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            await stop_tasks(tasks)
+
+    async def queue_jobs(self, generations, workflows: Optional[Dict[str, bytes]] = None, client_id: Optional[str] = None):
+        """Queue generations in ComfyUI, recording each step in the job state store"""
+        self.job_state.add_queued(generations)
+        # Downloads LoRAs and inputs, so keep it off the event loop
+        queued_jobs = await asyncio.to_thread(
+                queue_claimed_jobs,
+                generations,
                 self.comfyui_server,
                 self.api_url,
+                workflows=workflows,
+                client_id=client_id,
             )
-        previous_jobs_in_queue = 0
-        while True:
-            current_time = time.time()
-            
-            # Send heartbeat periodically during processing
-            if current_time - last_heartbeat_time >= heartbeat_interval:
-                if not self.send_heartbeat():
-                    logger.warning("Failed to send heartbeat during batch processing, but continuing...")
-                last_heartbeat_time = current_time
-            
-            jobs_in_queue = jobs_in_comfyui_queue(self.comfyui_server)
-            if jobs_in_queue - previous_jobs_in_queue < 0 or jobs_in_queue == 0:
-                # if jobs in queue is less than previous jobs in queue, upload the completed jobs
-                queued_jobs = check_completed_jobs_and_get_outputs(
-                    queued_jobs, self.comfyui_output_path, self.comfyui_server, self.api_url
-                )
-                queued_jobs = upload_completed_jobs(
-                    queued_jobs,
+        self.job_state.mark_submitted(queued_jobs)
+        # Jobs that failed to queue were already reported to the API
+        queued_ids = {str(job.job["_id"]) for job in queued_jobs}
+        self.job_state.discard(str(g["_id"]) for g in generations if str(g["_id"]) not in queued_ids)
+        return queued_jobs
+
+    async def complete_queued_jobs(self, queued_jobs, ws: Optional[aiohttp.ClientWebSocketResponse] = None, batch_id: str = "resumed", client_id: Optional[str] = None) -> bool:
+        """
+        Wait for queued jobs to finish in ComfyUI, uploading outputs as each one completes.
+        Returns once generation is done; the remaining uploads drain in self.upload_tasks.
+        """
+        # Upload outputs as soon as each job completes, while the rest keep generating
+        upload_queue: asyncio.Queue = asyncio.Queue()
+        upload_workers = [
+            asyncio.create_task(self.upload_worker(upload_queue))
+            for _ in range(self.upload_concurrency)
+        ]
+        timed_out = False
+        try:
+            # wait_for cancels the wait even if ComfyUI stops answering mid-request
+            await asyncio.wait_for(
+                self.wait_for_queued_jobs(queued_jobs, ws, upload_queue, batch_id, client_id),
+                timeout=MAX_BATCH_PROCESSING_TIME,
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Batch processing timed out after {MAX_BATCH_PROCESSING_TIME} seconds")
+            timed_out = True
+            # unload models and empty memory
+            await asyncio.to_thread(unload_models_and_empty_memory, self.comfyui_server)
+            await self.fail_unfinished_jobs(queued_jobs, upload_queue)
+        except BaseException:
+            await stop_tasks(upload_workers)
+            raise
+        finally:
+            self.active_batches.pop(batch_id, None)
+        # Let the GPU start on the next batch while this one's outputs upload
+        task = asyncio.create_task(self.drain_uploads(upload_queue, upload_workers))
+        self.upload_tasks.add(task)
+        task.add_done_callback(self.upload_tasks.discard)
+        return not timed_out
+
+    async def fail_unfinished_jobs(self, queued_jobs, upload_queue: asyncio.Queue):
+        """After a timeout, upload jobs that finished in the last check and report the rest as failed"""
+        for job in list(queued_jobs):
+            if job.completed and job.output_path:
+                self.job_state.mark_completed(job)
+                upload_queue.put_nowait(job)
+                continue
+            try:
+                await asyncio.to_thread(
+                    handle_generation_error,
+                    f"Generation timed out after {MAX_BATCH_PROCESSING_TIME} seconds",
+                    job.job["_id"],
                     self.api_url,
-                    "movies",
-                    self.s3_client,
-                    "obobo-media-production",
                 )
-                if len(queued_jobs) == 0:
-                    break
-            previous_jobs_in_queue = jobs_in_queue
-            if time.time() - start_time > max_batch_processing_time:
-                logger.error(f"Batch processing timed out after {max_batch_processing_time} seconds")
-                # unload models and empty memory
-                unload_models_and_empty_memory(self.comfyui_server)
-                return False
+            except Exception as e:
+                # Left in the job state store, so the next start picks it up again
+                logger.error(f"Failed to report timed out job {job.job['_id']}: {e}")
+                continue
+            self.job_state.discard([job.job["_id"]])
 
-            # if any jobs in the comfyui queue, wait
-            if jobs_in_queue > 0:
-                await asyncio.sleep(5)
-            elif not queued_jobs:
-                break
+    async def drain_uploads(self, upload_queue: asyncio.Queue, upload_workers: List[asyncio.Task]):
+        """Wait for every queued upload to finish, then stop the upload workers"""
+        try:
+            await upload_queue.join()
+        finally:
+            await stop_tasks(upload_workers)
+
+    async def wait_for_uploads(self, max_pending: int = 0):
+        """Wait until at most max_pending batches still have uploads draining"""
+        while len(self.upload_tasks) > max_pending:
+            await asyncio.wait(self.upload_tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    async def wait_for_queued_jobs(self, queued_jobs, ws: Optional[aiohttp.ClientWebSocketResponse], upload_queue: asyncio.Queue, batch_id: str, client_id: Optional[str] = None):
+        """Hand jobs to the upload queue as they complete, removing them from queued_jobs"""
+        poll_interval = MIN_COMFYUI_POLL_INTERVAL
+        # Prompts ComfyUI reported finished since the last check; None until we know, which checks every job
+        finished_prompt_ids = None
+        try:
+            while True:
+                checked_ids = {str(job.job["_id"]) for job in queued_jobs}
+                await asyncio.to_thread(
+                    check_completed_jobs_and_get_outputs,
+                    queued_jobs, self.comfyui_output_path, self.comfyui_server, self.api_url,
+                    finished_prompt_ids,
+                )
+                # Jobs dropped by the check failed in ComfyUI and were reported to the API
+                self.job_state.discard(checked_ids - {str(job.job["_id"]) for job in queued_jobs})
+                for job in [job for job in queued_jobs if job.completed and job.output_path]:
+                    self.job_state.mark_completed(job)
+                    queued_jobs.remove(job)
+                    upload_queue.put_nowait(job)
+                self.active_batches[batch_id] = len(queued_jobs)
+                if len(queued_jobs) == 0:
+                    return
+                # ComfyUI runs prompts back to back, so the next one tends to finish soon after a completion
+                if len(queued_jobs) < len(checked_ids):
+                    poll_interval = MIN_COMFYUI_POLL_INTERVAL
+                else:
+                    poll_interval = min(MAX_COMFYUI_POLL_INTERVAL, poll_interval * 2)
 
-            await asyncio.sleep(1)  # Add a small delay to prevent tight loop
-        await asyncio.sleep(5) 
-        # unload_models_and_empty_memory(self.comfyui_server)
-        # await asyncio.sleep(10) 
-        return True
+                if ws is None or ws.closed:
+                    # Reconnecting with the same clientId keeps this batch's prompt events coming to us
+                    ws = await self.connect_comfyui_events(client_id or self.new_comfyui_client_id())
+                finished_prompt_ids = await self.wait_for_comfyui_event(ws, prompt_ids={job.prompt_id for job in queued_jobs}, fallback_interval=poll_interval)
+        finally:
+            if ws is not None:
+                await ws.close()
 
+    async def resume_pending_jobs(self):
+        """Finish jobs left over from a previous run of this worker"""
+        pending = self.job_state.pending()
+        if not pending:
+            return
+        logger.info(f"Resuming {len(pending)} jobs from a previous run")
+        # Prompts still in ComfyUI were queued under the previous run's clientId, so only its
+        # status broadcasts wake us for those; requeued jobs use this socket's clientId
+        client_id = self.new_comfyui_client_id()
+        ws = await self.connect_comfyui_events(client_id)
+        queued_jobs = []
+        to_requeue = []
+        for job, status, prompt_id, output_path in pending:
+            if status == "completed" and output_path and os.path.exists(output_path):
+                queued_jobs.append(QueuedJob(job=job, workflow_prompt={}, prompt_id=prompt_id, completed=True, output_path=output_path))
+            elif status == "submitted" and await asyncio.to_thread(comfyui_knows_prompt, self.comfyui_server, prompt_id):
+                queued_jobs.append(QueuedJob(job=job, workflow_prompt={}, prompt_id=prompt_id))
+            else:
+                # Never reached ComfyUI, or ComfyUI restarted and lost it
+                to_requeue.append(job)
+        if to_requeue:
+            queued_jobs += await self.queue_jobs(to_requeue, client_id=client_id)
+        await self.complete_queued_jobs(queued_jobs, ws, client_id=client_id)
+
+    def new_comfyui_client_id(self) -> str:
+        return f"{self.worker_id}-{uuid.uuid4().hex[:8]}"
+
+    async def connect_comfyui_events(self, client_id: str) -> Optional[aiohttp.ClientWebSocketResponse]:
+        """Open ComfyUI's websocket as client_id so batch processing wakes up on queue changes and prompt ends"""
+        ws_url = f"{self.comfyui_server.replace('http', 'ws', 1)}/ws?clientId={client_id}"
+        try:
+            return await self.http.ws_connect(ws_url, heartbeat=30)
+        except Exception as e:
+            logger.warning(f"Could not connect to ComfyUI websocket, falling back to polling: {e}")
+            return None
 
+    async def wait_for_comfyui_event(self, ws: Optional[aiohttp.ClientWebSocketResponse], timeout: float = 30, prompt_ids: Optional[set] = None, fallback_interval: float = MAX_COMFYUI_POLL_INTERVAL) -> Optional[set]:
+        """
+        Wait until ComfyUI reports a queue change or the end of one of prompt_ids, or at most timeout seconds.
+        Returns the finished prompt ids, or None if we can't tell which prompt it was (a "status" queue change,
+        no websocket, socket closed, timed out), in which case every job gets its own /history/{prompt_id} check.
+        """
+        if ws is None or ws.closed:
+            await asyncio.sleep(fallback_interval)
+            return None
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                msg = await asyncio.wait_for(ws.receive(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                # Binary messages are previews, not state changes
+                event = orjson.loads(msg.data)
+                if is_completion_event(event, prompt_ids):
+                    prompt_id = (event.get("data") or {}).get("prompt_id")
+                    return {prompt_id} if prompt_id else None
+            elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                return None
+        return None
 
+    async def upload_job(self, job) -> bool:
+        """
+        Upload a single completed job. botocore's adaptive retries are the only retry layer;
+        throttling that outlasts them halves the upload limit, and each successful upload raises it by one.
+        """
+        async with self.upload_slots:
+            await self.upload_slots.wait_for(lambda: self.in_flight_uploads < self.upload_limit)
+            self.in_flight_uploads += 1
+            started_limit = self.upload_limit
+        uploaded = False
+        try:
+            uploaded = await asyncio.to_thread(
+                upload_completed_job, job, self.api_url, S3_PREFIX, self.s3_transfer, S3_BUCKET
+            )
+            return uploaded
+        except (ClientError, S3UploadFailedError, HTTPError) as e:
+            if is_s3_throttle_error(e):
+                # Uploads throttled together halve the limit once, not once each
+                self.upload_limit = min(self.upload_limit, max(1, started_limit // 2))
+                logger.warning(f"S3 throttled upload of job {job.job['_id']} ({e}), lowering upload concurrency to {self.upload_limit}")
+            raise
+        finally:
+            async with self.upload_slots:
+                self.in_flight_uploads -= 1
+                if uploaded:
+                    self.upload_limit = min(self.upload_concurrency, self.upload_limit + 1)
+                self.upload_slots.notify_all()
+
+    async def upload_or_report(self, job):
+        """Upload a completed job, reporting it as failed to the API if the upload doesn't succeed"""
+        try:
+            if not await self.upload_job(job):
+                raise RuntimeError(f"Could not upload output {job.output_path}")
+        except Exception as e:
+            logger.error(f"Failed to upload job {job.job['_id']}: {e}")
+            await asyncio.to_thread(
+                handle_generation_error, f"Failed to upload output: {e}", job.job["_id"], self.api_url
+            )
 
+    async def upload_worker(self, upload_queue: asyncio.Queue):
+        """Upload completed jobs from the queue until cancelled"""
+        while True:
+            job = await upload_queue.get()
+            try:
+                await self.upload_or_report(job)
+            except Exception:
+                # Not even the failure could be reported; keep the job so the next start tries again
+                logger.exception(f"Could not upload or report job {job.job['_id']}")
+            else:
+                # Forget the job only once it was uploaded or reported failed;
+                # a cancelled upload stays in the store and resumes on the next start
+                self.job_state.discard([job.job["_id"]])
+            finally:
+                upload_queue.task_done()
 
     async def run_single_batch(self):
         """Process a single specified batch and exit"""
@@ -220,7 +582,7 @@ class Worker:
 
         try:
             # Register worker (includes readiness check and activation)
-            if not self.register():
+            if not await self.register():
                 logger.error(f"Failed to register worker in single batch mode")
                 return
 
@@ -232,18 +594,19 @@ class Worker:
             logger.error(f"Error in single batch mode: {e}")
         finally:
             if self.registered:
-                self.unregister()
+                await self.unregister()
 
     async def run_continuous(self):
         """Run in continuous mode, polling for batches"""
         shutdown_info = " (EC2 instance will be terminated)" if self.shutdown_machine else ""
         logger.info(f"Worker will request coordinated shutdown after {self.max_idle_time} seconds without jobs{shutdown_info}")
         
-        while True:
+        resumed = False
+        while not self.stop_event.is_set():
             try:
                 
                 # Check if we should shutdown due to inactivity
-                current_time = time.time()
+                current_time = time.monotonic()
                 idle_time = current_time - self.last_job_time
                 
                 if idle_time > self.max_idle_time and not self.idle_flag_written:
@@ -252,47 +615,110 @@ class Worker:
                     self.idle_flag_written = True
                 
                 # Register (which includes readiness check and marking as active)
-                if not self.registered and not self.register():
+                if not self.registered and not await self.register():
                     logger.error(f"Failed to register worker, retrying in 10 seconds...")
-                    await asyncio.sleep(10)
+                    await self.sleep_unless_stopped(10)
                     continue
 
-                # Send heartbeat
-                if not self.send_heartbeat():
-                    logger.error(
-                        f"Failed to send heartbeat, attempting to re-register..."
-                    )
-                    self.registered = False
-                    continue
+                # Finish any batch interrupted by a crash before claiming new work
+                if not resumed:
+                    if not await self.run_unless_stopped(self.resume_pending_jobs()):
+                        break
+                    resumed = True
 
-                # Get and process next batch
-                batch = self.get_next_batch()
-                if batch:
+                # Prefetch the next batches while the previous ones upload, but
+                # don't let more than one poll's worth of uploads pile up
+                if not await self.run_unless_stopped(self.wait_for_uploads(self.max_batches_per_poll)):
+                    break
+
+                # Get and process next batches
+                poll_start = time.monotonic()
+                poll = asyncio.create_task(self.get_next_batches(self.max_batches_per_poll))
+                if not await self.run_unless_stopped(poll):
+                    break
+                batches = poll.result()
+                poll_duration = time.monotonic() - poll_start
+                if batches:
+                    self.poll_delay = MIN_POLL_DELAY
                     
                     # Reset idle timer when we get a job
-                    self.last_job_time = time.time()
+                    self.last_job_time = time.monotonic()
                     # Clear any pending shutdown flag since we are active again
                     if self.idle_flag_written:
                         self.clear_shutdown_flag()
-                    logger.info(f"Received batch data: {batch}")
-                    logger.info(f"Processing batch with {len(batch['generations'])} generations")
-                    await self.process_batch(batch)
+                    for batch in batches:
+                        logger.info("Received batch: generations=%d workflow=%s", len(batch.get("generations", [])), batch.get("workflow_url"))
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Full batch: %s", batch)
+                    # ComfyUI jobs are tracked by prompt_id, so batches can share the queue
+                    if not await self.run_unless_stopped(self.process_batches(batches)):
+                        # Unfinished jobs stay in the job state store and resume on the next start
+                        logger.info("Shutdown requested, abandoning in-progress batches")
+                        break
                     # Reset idle timer after completing the batch processing
-                    self.last_job_time = time.time() 
+                    self.last_job_time = time.monotonic() 
                 else:
                     
                     # Log idle status every minute when no jobs
-                    if int(idle_time) % 60 == 0 and int(idle_time) > 0:
+                    if idle_time >= 60 and current_time - self.last_idle_log_time >= 60:
+                        self.last_idle_log_time = current_time
                         remaining_time = self.max_idle_time - idle_time
                         logger.info(f"No jobs for {int(idle_time)}s. Will auto-shutdown in {int(remaining_time)}s if no jobs received.")
                     
-                    logger.info(f"No batches available, waiting {self.batch_wait_time} seconds...")
-                    await asyncio.sleep(self.batch_wait_time)
+                    # A long-polling API already waited for us; an immediate empty answer means back off
+                    if poll_duration < MIN_POLL_DELAY:
+                        # Jitter keeps a fleet of idle workers from polling in lockstep
+                        delay = self.poll_delay * random.uniform(0.5, 1.5)
+                        logger.info(f"No batches available, waiting {delay:.1f} seconds...")
+                        await self.sleep_unless_stopped(delay)
+                        self.poll_delay = min(MAX_POLL_DELAY, self.poll_delay * 2)
+                self.consecutive_failures = 0
+
+            except aiohttp.ClientResponseError as e:
+                logger.error(f"API error in continuous mode: {e}")
+                # Only an API that no longer knows us needs a fresh registration
+                if e.status in (401, 403, 404):
+                    self.registered = False
+                await self.back_off_after_failure()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                logger.error(f"Network error in continuous mode: {e!r}")
+                await self.back_off_after_failure()
+            except Exception:
+                # A bad batch shouldn't cost a re-registration; move on to the next one
+                logger.exception("Error in continuous mode")
+                await self.back_off_after_failure()
+
+    async def run_unless_stopped(self, aw) -> bool:
+        """
+        Await aw until it finishes or shutdown is requested; in that case cancel it and wait for it to unwind.
+        Returns True if aw finished; its exception, if any, is raised.
+        """
+        task = asyncio.ensure_future(aw)
+        stopping = asyncio.create_task(self.stop_event.wait())
+        try:
+            await asyncio.wait({task, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopping.cancel()
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+        if task.cancelled():
+            return False
+        task.result()
+        return True
 
-            except Exception as e:
-                logger.error(f"Error in continuous mode: {e}")
-                self.registered = False
-                await asyncio.sleep(self.batch_wait_time)
+    async def back_off_after_failure(self):
+        """Sleep with jittered exponential backoff (0.25s up to 30s) over consecutive failures"""
+        delay = min(0.25 * 2 ** self.consecutive_failures, 30) * random.uniform(0.5, 1.5)
+        self.consecutive_failures += 1
+        await self.sleep_unless_stopped(delay)
+
+    async def sleep_unless_stopped(self, delay: float):
+        """Sleep for delay seconds, returning early if shutdown is requested"""
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
     
     def signal_shutdown_to_parent(self):
@@ -304,13 +730,14 @@ class Worker:
             
             # Ensure /tmp is writable and create the flag file
             os.makedirs("/tmp", exist_ok=True)
-            with open(flag_file, 'w') as f:
+            # Write then rename so run_workers.sh never sees a partial flag; no fsync needed for a signal file
+            tmp_file = f"{flag_file}.tmp"
+            with open(tmp_file, 'w') as f:
                 f.write(f"AUTO_SHUTDOWN_IDLE:{shutdown_type}:{time.time()}")
-                f.flush()  # Ensure data is written immediately
-                os.fsync(f.fileno())  # Force write to disk
             
             # Set readable permissions
-            os.chmod(flag_file, 0o644)
+            os.chmod(tmp_file, 0o644)
+            os.rename(tmp_file, flag_file)
             
             logger.info(f"Created shutdown flag: {flag_file} (type: {shutdown_type})")
             
@@ -325,7 +752,6 @@ class Worker:
                 
         except Exception as e:
             logger.error(f"Failed to create shutdown flag: {e}")
-            import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
 
     def clear_shutdown_flag(self):
@@ -341,21 +767,68 @@ class Worker:
 
     async def run(self):
         """Main worker run loop"""
+        self.http = self.create_http_session()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop_event.set)
         try:
             if self.batch and self.batch != "{}":
-                await self.run_single_batch()
+                await self.run_unless_stopped(self.run_single_batch())
             else:
                 await self.run_continuous()
             
             # Coordinated idle shutdown is handled by parent script; do not self-terminate here.
-        except KeyboardInterrupt:
-            logger.info(f"Received shutdown signal")
+            if self.stop_event.is_set():
+                logger.info(f"Received shutdown signal")
         finally:
+            # Outputs not uploaded yet are in the job state store and resume on the next start;
+            # wait for the uploads to unwind before the store is closed below
+            await stop_tasks(self.upload_tasks)
             if self.registered:
-                self.unregister()
+                await self.unregister()
+            self.stop_heartbeat()
+            await self.http.close()
+            self.job_state.close()
             logger.info("Worker shutdown complete")
 
 
+async def stop_tasks(tasks):
+    """Cancel tasks and wait until all of them have finished unwinding"""
+    tasks = list(tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def is_completion_event(event: Dict[str, Any], prompt_ids: Optional[set] = None) -> bool:
+    """True if a ComfyUI websocket event may mean one of prompt_ids finished"""
+    event_type = event.get("type")
+    if event_type not in COMFYUI_WAKE_EVENTS:
+        return False
+    if event_type == "status":
+        return True
+    data = event.get("data") or {}
+    # "executing" fires for every node; node None marks the end of the prompt
+    if event_type == "executing" and data.get("node") is not None:
+        return False
+    return prompt_ids is None or data.get("prompt_id") in prompt_ids
+
+
+def is_s3_throttle_error(error: Exception) -> bool:
+    """True for S3 SlowDown/throttling and 5xx errors, which mean we are uploading too fast"""
+    # upload_file raises S3UploadFailedError while handling the underlying ClientError
+    if isinstance(error, S3UploadFailedError) and isinstance(error.__context__, ClientError):
+        error = error.__context__
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in ("SlowDown", "Throttling", "RequestLimitExceeded") or status >= 500
+    # Presigned uploads fail through raise_for_status, which keeps the response
+    if isinstance(error, HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
 def main():
     parser = argparse.ArgumentParser(description="Montecristo Inference Worker")
     parser.add_argument(
@@ -376,6 +849,9 @@ def main():
     parser.add_argument("--shutdown_machine", action="store_true", help="Enable automatic EC2 instance termination after worker auto-shutdown")
     parser.add_argument("--instance_id", required=True, help="Instance ID for the worker")
     parser.add_argument("--tunnel_url", default=None, help="Tunnel URL provided by parent script")
+    parser.add_argument("--upload_mode", choices=["s3", "presigned"], default="s3", help="Upload outputs with the worker's S3 credentials or through presigned URLs issued by the API (default: s3)")
+    parser.add_argument("--upload_concurrency", type=int, default=8, help="Maximum number of concurrent S3 uploads (default: 8)")
+    parser.add_argument("--max_batches_per_poll", type=int, default=1, help="Maximum number of batches claimed and processed at once by this worker's ComfyUI (default: 1)")
 
     args = parser.parse_args()
 
@@ -398,12 +874,17 @@ def main():
         shutdown_machine=args.shutdown_machine,
         instance_id=args.instance_id,
         tunnel_url=args.tunnel_url,
+        upload_concurrency=args.upload_concurrency,
+        upload_mode=args.upload_mode,
+        max_batches_per_poll=args.max_batches_per_poll,
     )
 
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(worker.run())
     except KeyboardInterrupt:
-        worker.unregister()
+        # run() unregisters the worker in its finally block
         logger.info(f"Worker shutdown complete")
 
 
@@ -56,12 +56,13 @@ cleanup_all() {
         fi
     done
     
-    # Also kill any ComfyUI, worker, and cloudflared processes that might still be running
-    echo "Cleaning up any remaining ComfyUI, worker, and cloudflared processes..."
-    pkill -f "python3 main.py --port" 2>/dev/null || true
-    pkill -f "python3 main.py --api-url" 2>/dev/null || true
-    # Kill all cloudflared processes since all workers managed by this script are shutting down
-    pkill -f "cloudflared" 2>/dev/null || true
+    # Every ComfyUI and worker this script started is in PIDS and was stopped above,
+    # so there is no need to scan the process table for them
+    echo "Cleaning up any remaining cloudflared processes..."
+    # Stop the tunnels started by this script, leaving any other cloudflared on the host alone
+    for pid in "${CLOUDFLARED_PIDS[@]}"; do
+        kill -KILL -- "-$pid" 2>/dev/null || true
+    done
     
     # Clean up tunnel log files
     rm -f /tmp/cloudflared_*.log 2>/dev/null || true
@@ -102,12 +103,13 @@ cleanup_for_machine_shutdown() {
         fi
     done
     
-    # Also kill any ComfyUI, worker, and cloudflared processes that might still be running
-    echo "Cleaning up any remaining ComfyUI, worker, and cloudflared processes..."
-    pkill -f "python3 main.py --port" 2>/dev/null || true
-    pkill -f "python3 main.py --api-url" 2>/dev/null || true
-    # Kill all cloudflared processes since all workers managed by this script are shutting down
-    pkill -f "cloudflared" 2>/dev/null || true
+    # Every ComfyUI and worker this script started is in PIDS and was stopped above,
+    # so there is no need to scan the process table for them
+    echo "Cleaning up any remaining cloudflared processes..."
+    # Stop the tunnels started by this script, leaving any other cloudflared on the host alone
+    for pid in "${CLOUDFLARED_PIDS[@]}"; do
+        kill -KILL -- "-$pid" 2>/dev/null || true
+    done
     
     # Clean up tunnel log files
     rm -f /tmp/cloudflared_*.log 2>/dev/null || true
@@ -115,26 +117,36 @@ cleanup_for_machine_shutdown() {
     echo "Process cleanup completed. Initiating EC2 instance termination..."
 }
 
+# Send SIGTERM and wait up to 2 seconds for the process to exit, only force killing it if it doesn't.
+# With "group" as second argument, signal the whole process group led by the pid.
+stop_process() {
+    local pid=$1
+    if [ -z "$pid" ]; then
+        return
+    fi
+    local target=$pid
+    if [ "$2" = "group" ]; then
+        target="-$pid"
+    fi
+    if ! kill -0 -- "$target" 2>/dev/null; then
+        return
+    fi
+    kill -TERM -- "$target" 2>/dev/null || true
+    for _ in $(seq 20); do
+        kill -0 -- "$target" 2>/dev/null || return
+        sleep 0.1
+    done
+    kill -KILL -- "$target" 2>/dev/null || true
+}
+
 cleanup_worker() {
     local gpu_id=$1
     local worker_id="${INSTANCE_ID}_${gpu_id}"
     echo "Cleaning up worker processes for GPU ${gpu_id} (worker ${worker_id})..."
     # Kill specific processes for this worker
-    if [ -n "${COMFYUI_PIDS[$gpu_id]}" ] && kill -0 "${COMFYUI_PIDS[$gpu_id]}" 2>/dev/null; then
-        kill -TERM "${COMFYUI_PIDS[$gpu_id]}" 2>/dev/null || true
-        sleep 1
-        kill -KILL "${COMFYUI_PIDS[$gpu_id]}" 2>/dev/null || true
-    fi
-    if [ -n "${WORKER_PIDS[$gpu_id]}" ] && kill -0 "${WORKER_PIDS[$gpu_id]}" 2>/dev/null; then
-        kill -TERM "${WORKER_PIDS[$gpu_id]}" 2>/dev/null || true
-        sleep 1
-        kill -KILL "${WORKER_PIDS[$gpu_id]}" 2>/dev/null || true
-    fi
-    if [ -n "${CLOUDFLARED_PIDS[$gpu_id]}" ] && kill -0 "${CLOUDFLARED_PIDS[$gpu_id]}" 2>/dev/null; then
-        kill -TERM "${CLOUDFLARED_PIDS[$gpu_id]}" 2>/dev/null || true
-        sleep 1
-        kill -KILL "${CLOUDFLARED_PIDS[$gpu_id]}" 2>/dev/null || true
-    fi
+    stop_process "${COMFYUI_PIDS[$gpu_id]}"
+    stop_process "${WORKER_PIDS[$gpu_id]}"
+    stop_process "${CLOUDFLARED_PIDS[$gpu_id]}" group
     rm -f "/tmp/cloudflared_${worker_id}.log" 2>/dev/null || true
     rm -f "/tmp/worker_shutdown_${worker_id}.flag" 2>/dev/null || true
     # Unset entries to mark worker inactive
@@ -143,6 +155,19 @@ cleanup_worker() {
     unset CLOUDFLARED_PIDS[$gpu_id]
 }
 
+# Print the NUMA node the GPU is attached to, or -1 if unknown
+gpu_numa_node() {
+    local bus_id
+    bus_id=$(nvidia-smi -i "$1" --query-gpu=pci.bus_id --format=csv,noheader 2>/dev/null | tr 'A-F' 'a-f')
+    # nvidia-smi prints an 8 digit PCI domain, sysfs uses 4
+    local node_file="/sys/bus/pci/devices/${bus_id: -12}/numa_node"
+    if [ -n "$bus_id" ] && [ -r "$node_file" ]; then
+        cat "$node_file"
+    else
+        echo -1
+    fi
+}
+
 start_worker() {
     local gpu_id=$1
     local comfyui_port=$((8100 + gpu_id))
@@ -150,14 +175,32 @@ start_worker() {
     
     echo "Starting new worker for GPU ${gpu_id} (worker ${worker_id})..."
     
+    # On multi-socket machines keep ComfyUI on the CPUs and memory local to its GPU
+    local numa_prefix=""
+    local numa_node
+    numa_node=$(gpu_numa_node "$gpu_id")
+    if [ "$numa_node" -ge 0 ] 2>/dev/null && command -v numactl > /dev/null 2>&1; then
+        numa_prefix="numactl --cpunodebind=$numa_node --preferred=$numa_node"
+        echo "Pinning ComfyUI for GPU ${gpu_id} to NUMA node ${numa_node}"
+    fi
+
     # Start ComfyUI
     cd ../../../
-    CUDA_VISIBLE_DEVICES=$gpu_id python3 main.py --port $comfyui_port --lowvram --dont-upcast-attention &
+    CUDA_VISIBLE_DEVICES=$gpu_id $numa_prefix python3 main.py --port $comfyui_port --lowvram --dont-upcast-attention &
     local comfyui_pid=$!
     cd - > /dev/null
     PIDS+=($comfyui_pid)
     COMFYUI_PIDS[$gpu_id]=$comfyui_pid
 
+    # Create cloudflared tunnel right away; it doesn't need ComfyUI to be up to hand out a URL,
+    # so the tunnel handshake overlaps ComfyUI's startup instead of following it
+    echo "Creating cloudflared tunnel for port $comfyui_port..."
+    # Own session and process group, so cleanup can signal exactly this tunnel
+    setsid cloudflared tunnel --url "http://localhost:$comfyui_port" --no-autoupdate > /tmp/cloudflared_${worker_id}.log 2>&1 &
+    local cloudflared_pid=$!
+    PIDS+=($cloudflared_pid)
+    CLOUDFLARED_PIDS[$gpu_id]=$cloudflared_pid
+
     # Wait for ComfyUI to start
     while ! curl -s "http://127.0.0.1:$comfyui_port" > /dev/null 2>&1; do
         echo "Waiting for ComfyUI to start on port $comfyui_port..."
@@ -165,37 +208,29 @@ start_worker() {
     done
 
     sleep 1
-
-    # Create cloudflared tunnel
-    echo "Creating cloudflared tunnel for port $comfyui_port..."
-    cloudflared tunnel --url "http://localhost:$comfyui_port" --no-autoupdate > /tmp/cloudflared_${worker_id}.log 2>&1 &
-    local cloudflared_pid=$!
-    PIDS+=($cloudflared_pid)
-    CLOUDFLARED_PIDS[$gpu_id]=$cloudflared_pid
     
-    # Wait for tunnel URL
+    # Wait for tunnel URL; grep stops at the first match, so each check is cheap enough to poll every 0.1s
     echo "Waiting for cloudflared tunnel URL..."
     local tunnel_url=""
-    for attempt in {1..30}; do
-        if [ -f "/tmp/cloudflared_${worker_id}.log" ]; then
-            tunnel_url=$(grep -o 'https://[a-zA-Z0-9-]*\.trycloudflare\.com' "/tmp/cloudflared_${worker_id}.log" | head -1)
-            if [ -n "$tunnel_url" ]; then
-                echo "Cloudflared tunnel created successfully: $tunnel_url"
-                break
-            fi
+    local tunnel_deadline=$((SECONDS + 30))
+    while [ $SECONDS -lt $tunnel_deadline ]; do
+        tunnel_url=$(grep -m 1 -o 'https://[a-zA-Z0-9-]*\.trycloudflare\.com' "/tmp/cloudflared_${worker_id}.log" 2>/dev/null)
+        if [ -n "$tunnel_url" ]; then
+            echo "Cloudflared tunnel created successfully: $tunnel_url"
+            break
         fi
-        sleep 1
-        if [ $((attempt % 5)) -eq 0 ]; then
-            echo "Still waiting for cloudflared tunnel URL... ($attempt/30)"
+        # No point waiting out the deadline if cloudflared already exited
+        if ! kill -0 "$cloudflared_pid" 2>/dev/null; then
+            echo "cloudflared exited before printing a tunnel URL"
+            break
         fi
+        sleep 0.1
     done
     
     if [ -z "$tunnel_url" ]; then
-        echo "Failed to get cloudflared tunnel URL after 30 seconds"
+        echo "Failed to get cloudflared tunnel URL"
         tunnel_url=""
     fi
-
-    sleep 1
     
     # Start the worker
     CUDA_VISIBLE_DEVICES=$gpu_id python3 main.py \
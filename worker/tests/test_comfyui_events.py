@@ -0,0 +1,126 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Worker
+
+
+class FakeComfyUI:
+    """Routes websocket events the way ComfyUI's PromptServer does (see worker/server.py)"""
+
+    def __init__(self):
+        self.sockets = {}
+        self.app = web.Application()
+        self.app.router.add_get("/ws", self.websocket_handler)
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def websocket_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sid = request.rel_url.query.get("clientId", "")
+        if sid:
+            # Reusing existing session, remove old
+            self.sockets.pop(sid, None)
+        else:
+            sid = uuid.uuid4().hex
+        self.sockets[sid] = ws
+        await self.send("status", {"status": self.queue_info(), "sid": sid}, sid)
+        async for _ in ws:
+            pass
+        self.sockets.pop(sid, None)
+        return ws
+
+    def queue_info(self):
+        return {"exec_info": {"queue_remaining": 0}}
+
+    async def send(self, event, data, sid=None):
+        """Broadcast when sid is None, otherwise only to the socket of that client"""
+        message = {"type": event, "data": data}
+        if sid is None:
+            for ws in list(self.sockets.values()):
+                await ws.send_json(message)
+        elif sid in self.sockets:
+            await self.sockets[sid].send_json(message)
+
+    async def finish_prompt(self, prompt_id, client_id):
+        """The events ComfyUI sends when a prompt queued with client_id finishes"""
+        await self.send("executing", {"node": None, "prompt_id": prompt_id}, client_id)
+        await self.send("execution_success", {"prompt_id": prompt_id, "timestamp": 0}, client_id)
+        # queue_updated() broadcasts the new queue to every socket
+        await self.send("status", {"status": self.queue_info()})
+
+
+def make_worker(comfyui_server, http):
+    """A Worker with only what the websocket methods use, so no GPU, S3 or job store is needed"""
+    worker = Worker.__new__(Worker)
+    worker.worker_id = "test-worker"
+    worker.comfyui_server = comfyui_server
+    worker.http = http
+    return worker
+
+
+def run_with_comfyui(test):
+    async def run():
+        comfyui = FakeComfyUI()
+        await comfyui.start()
+        try:
+            async with aiohttp.ClientSession() as http:
+                await test(comfyui, make_worker(comfyui.url, http))
+        finally:
+            await comfyui.stop()
+
+    asyncio.run(run())
+
+
+def test_status_broadcast_wakes_for_prompts_of_other_clients():
+    async def test(comfyui, worker):
+        ws = await worker.connect_comfyui_events(worker.new_comfyui_client_id())
+        # The status ComfyUI sends on connect
+        assert await worker.wait_for_comfyui_event(ws, timeout=5) is None
+
+        # A prompt queued under some other client_id; only the status broadcast reaches this socket
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, lambda: asyncio.ensure_future(comfyui.finish_prompt("prompt-1", "another-client")))
+        start = time.monotonic()
+        assert await worker.wait_for_comfyui_event(ws, timeout=5, prompt_ids={"prompt-1"}) is None
+        assert time.monotonic() - start < 2
+        await ws.close()
+
+    run_with_comfyui(test)
+
+
+def test_prompt_events_reach_the_socket_it_was_queued_under():
+    async def test(comfyui, worker):
+        client_id = worker.new_comfyui_client_id()
+        ws = await worker.connect_comfyui_events(client_id)
+        # The status ComfyUI sends on connect
+        assert await worker.wait_for_comfyui_event(ws, timeout=5) is None
+
+        # Queued with the socket's clientId, so ComfyUI tells us which prompt finished
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, lambda: asyncio.ensure_future(comfyui.finish_prompt("prompt-1", client_id)))
+        start = time.monotonic()
+        assert await worker.wait_for_comfyui_event(ws, timeout=5, prompt_ids={"prompt-1"}) == {"prompt-1"}
+        assert time.monotonic() - start < 2
+        await ws.close()
+
+    run_with_comfyui(test)
@@ -2,12 +2,16 @@ import os
 import re
 import json
 import copy
+import threading
+import mimetypes
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pydantic import BaseModel
 from typing import Optional
 import random
 from PIL import Image
-import cv2
 from dotenv import load_dotenv
 import logging
 
@@ -22,6 +26,37 @@ load_dotenv()
 
 # Path to ComfyUI root directory (3 levels up from worker/utils/)
 COMFYUI_PATH = "../../.."
+# civitai model id: the numbers between / and ?
+CIVITAI_ID_RE = re.compile(r"/(\d+)\?")
+# (connect, read) timeout for calls to the local ComfyUI server, so a hung server can't stall the worker
+COMFYUI_TIMEOUT = (5, 30)
+# (connect, read) timeout for the API, downloads and S3; the read timeout bounds each socket read, not the transfer
+API_TIMEOUT = (10, 60)
+
+
+# Retry gateway errors from the API; PUT bodies are file streams, so PUT is never retried
+API_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=frozenset({"GET", "POST", "DELETE"}),
+    raise_on_status=False,
+)
+
+
+def create_http_session(pool_maxsize: int = 16, max_retries=0) -> requests.Session:
+    """Keep-alive session safe to share between the worker's threads"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=max_retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by every call to the inference API and S3, including those made from upload threads
+api_session = create_http_session(max_retries=API_RETRY)
+# Shared by every call to the local ComfyUI server; not retried, a repeated POST /prompt would queue twice
+comfyui_session = create_http_session(pool_maxsize=8)
 
 
 class QueuedJob(BaseModel):
@@ -33,10 +68,27 @@ class QueuedJob(BaseModel):
     comfyui_status: Optional[str] = "queued"
 
 
+def save_streamed_response(response, file_path):
+    """Write a streamed download next to file_path and rename it into place, so concurrent batches never see a partial file"""
+    tmp_path = f"{file_path}.{threading.get_ident()}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=8192):
+                if chunk:
+                    f.write(chunk)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        # Don't leave partial downloads piling up in the models and workflows folders
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
 def download_civitai_lora(url, loras_folder):
     def get_civitai_id(url):
-        # match numbers between / and ?
-        match = re.search(r"/(\d+)\?", url)
+        match = CIVITAI_ID_RE.search(url)
         if match:
             return match.group(1)
         else:
@@ -52,11 +104,9 @@ def download_civitai_lora(url, loras_folder):
     # if file exists, return the path
     if os.path.exists(file_path):
         return file_path
-    response = requests.get(url, stream=True)
-    with open(file_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                file.write(chunk)
+    with api_session.get(url, stream=True, timeout=API_TIMEOUT) as response:
+        response.raise_for_status()
+        save_streamed_response(response, file_path)
     return file_path
 
 
@@ -69,15 +119,19 @@ def download_file(url, folder, debug=False):
         os.makedirs(folder)
     if os.path.exists(file_path):
         return file_path
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(file_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        return file_path
-    else:
-        logger.error("Failed to download %s - status code: %s", url, response.status_code)
-        return None
+    with api_session.get(url, stream=True, timeout=API_TIMEOUT) as response:
+        if response.status_code == 200:
+            save_streamed_response(response, file_path)
+            return file_path
+        else:
+            logger.error("Failed to download %s - status code: %s", url, response.status_code)
+            return None
+
+
+def fetch_workflow(url) -> bytes:
+    response = api_session.get(url, timeout=API_TIMEOUT)
+    response.raise_for_status()
+    return response.content
 
 
 def queue_prompt(workflow_json, client_id, server):
@@ -85,21 +139,22 @@ def queue_prompt(workflow_json, client_id, server):
         "Content-Type": "application/json",
     }
     p = {"prompt": workflow_json, "client_id": client_id}
-    data = json.dumps(p).encode("utf-8")
-    response = requests.post(f"{server}/prompt", headers=headers, data=data)
-    return response.json()
+    data = orjson.dumps(p)
+    response = comfyui_session.post(f"{server}/prompt", headers=headers, data=data, timeout=COMFYUI_TIMEOUT)
+    return orjson.loads(response.content)
 
 
 def handle_generation_error(error_message, job_id, api_url, server=None):
 
     # Update the job status in the database
     logger.error("Updating job %s status to 'failed' with error message: %s", job_id, error_message)
-    response = requests.post(
+    response = api_session.post(
         f"{api_url}/v1/inference/update_generation_status_to_failed/{str(job_id)}", 
-        json={"error_message": error_message}
+        json={"error_message": error_message},
+        timeout=API_TIMEOUT,
     )
     # TODO: is this appropiate?
-    if "allocation on device" or "Allocation on device" in error_message.lower() and server:
+    if server and "allocation on device" in error_message.lower():
         logger.warning("Unloading models and emptying memory due to device allocation error")
         unload_models_and_empty_memory(server)
 
@@ -396,7 +451,7 @@ def fill_workflow_obobo_inputs(
 
 
 def jobs_in_comfyui_queue(server):
-    response = requests.get(f"{server}/prompt")
+    response = comfyui_session.get(f"{server}/prompt", timeout=COMFYUI_TIMEOUT)
     return response.json()["exec_info"]["queue_remaining"]
     
 
@@ -405,10 +460,19 @@ def queue_claimed_jobs(
     claimed_jobs,
     server,
     api_url,
+    workflows: Optional[dict] = None,
+    client_id: Optional[str] = None,
 ) -> list[QueuedJob]:
+    """
+    Queue claimed jobs in ComfyUI.
+    workflows optionally maps workflow URLs to already-fetched workflow JSON bytes.
+    client_id is the ComfyUI websocket that should receive the prompts' events, each job's _id if None.
+    """
     # convert claimed jobs into QueuedJobs
     queued_jobs = []
-    
+    # parsed workflows by URL, each job gets its own copy to fill
+    parsed_workflows = {}
+
 
     for job in claimed_jobs:
         try:
@@ -419,12 +483,17 @@ def queue_claimed_jobs(
             if not workflow_url:
                 raise Exception(f"No workflow URL found for job {job['_id']}")
             
-            workflow_file = download_file(workflow_url, "tmp/workflows")
-            logger.debug("Downloaded workflow to: %s", workflow_file)
+            if workflow_url not in parsed_workflows:
+                if workflows and workflow_url in workflows:
+                    parsed_workflows[workflow_url] = orjson.loads(workflows[workflow_url])
+                else:
+                    workflow_file = download_file(workflow_url, "tmp/workflows")
+                    logger.debug("Downloaded workflow to: %s", workflow_file)
+
+                    with open(workflow_file, "rb") as f:
+                        parsed_workflows[workflow_url] = orjson.loads(f.read())
+            workflow = copy.deepcopy(parsed_workflows[workflow_url])
 
-            with open(workflow_file, "rb") as f:
-                workflow = json.load(f)
-                
 
             # get inputs - use the new structure
             workflow_inputs = job["workflow_inputs"]
@@ -445,7 +514,7 @@ def queue_claimed_jobs(
             logger.debug("Queueing workflow to ComfyUI")
             response = queue_prompt(
                 workflow,
-                client_id=str(job["_id"]),
+                client_id=client_id or str(job["_id"]),
                 server=server,
             )
 
@@ -473,10 +542,20 @@ def queue_claimed_jobs(
     return queued_jobs
 
 
-def get_comfyui_history(prompt_id, server):
-    return requests.get(
-        f"{server}/history/{prompt_id}",
-    ).json()
+def get_comfyui_history(server, prompt_id):
+    """Return ComfyUI history for one prompt, keyed by prompt_id; empty until the prompt finishes"""
+    return orjson.loads(comfyui_session.get(f"{server}/history/{prompt_id}", timeout=COMFYUI_TIMEOUT).content)
+
+
+def comfyui_knows_prompt(server, prompt_id) -> bool:
+    """True if ComfyUI still has the prompt queued, running or in its history"""
+    if prompt_id in get_comfyui_history(server, prompt_id):
+        return True
+    queue = orjson.loads(comfyui_session.get(f"{server}/queue", timeout=COMFYUI_TIMEOUT).content)
+    return any(
+        item[1] == prompt_id
+        for item in queue.get("queue_running", []) + queue.get("queue_pending", [])
+    )
 
 
 def get_execution_time_from_history(job_history):
@@ -494,20 +573,26 @@ def get_execution_time_from_history(job_history):
 
 def update_status_to_running(queued_job, api_url,server):
     try:
-        queue_running_job = requests.get(f"{server}/queue").json()["queue_running"]
+        queue_running_job = comfyui_session.get(f"{server}/queue", timeout=COMFYUI_TIMEOUT).json()["queue_running"]
         if len(queue_running_job) > 0:
             queue_running_job = queue_running_job[0]
             if queue_running_job and queued_job.prompt_id == queue_running_job[1] or str(queued_job.job["_id"]) == queue_running_job[-2]["client_id"]:
                 queued_job.comfyui_status = "running"
-                requests.post(f"{api_url}/v1/inference/update_generation_status_to_running/{str(queued_job.job['_id'])}")
+                api_session.post(f"{api_url}/v1/inference/update_generation_status_to_running/{str(queued_job.job['_id'])}", timeout=API_TIMEOUT)
     except Exception as e:
         logger.error("Error updating status to running for job %s: %s", queued_job.job['_id'], e)
         return False
 
 
 def check_completed_jobs_and_get_outputs(
-    queued_jobs, base_output_path, server, api_url
+    queued_jobs, base_output_path, server, api_url, prompt_ids=None
 ):
+    # Plain /history returns everything ComfyUI retains, prompt graphs included, so ask per prompt;
+    # prompt_ids limits the check to prompts ComfyUI reported finished, None checks every job
+    history = {}
+    for job in queued_jobs:
+        if prompt_ids is None or job.prompt_id in prompt_ids:
+            history.update(get_comfyui_history(server, job.prompt_id))
     for job in queued_jobs:
         # Check if this is the currently running job
 
@@ -515,12 +600,11 @@ def check_completed_jobs_and_get_outputs(
         if "inference" not in job.job or job.job["inference"] is None:
             job.job["inference"] = {}
             
-        job_history = get_comfyui_history(job.prompt_id, server)
         # update_status_to_running(job, api_url, server)
-        if job.prompt_id not in job_history:
+        if job.prompt_id not in history:
             # logger.info(f"Job {job.prompt_id} not found in history.")
             continue
-        job_history = job_history[job.prompt_id]
+        job_history = history[job.prompt_id]
         if not job_history["status"]["completed"]:
             # logger.info(f"Job {job.prompt_id} is not completed yet.")
             if job_history["status"]["status_str"] == "error":
@@ -614,6 +698,9 @@ def create_display_image(input_path, generation_type):
                 im.save(webp_path, "webp")
             return webp_path
         elif generation_type == "video":
+            # OpenCV takes a few hundred ms to import and is only needed for video thumbnails
+            import cv2
+
             vidcap = cv2.VideoCapture(input_path)
             success, image = vidcap.read()
             vidcap.release()
@@ -637,209 +724,137 @@ def get_file_size_in_gigabytes(file_path):
         return 0
 
 
-def upload_completed_jobs(
-    queued_jobs,
+UPLOAD_EXTENSIONS = {
+    "image": ["png", "jpg", "jpeg"],
+    "video": ["mp4", "webp", "mov", "avi", "mkv", "webm", "gif"],
+    "audio": ["mp3", "wav", "flac", "aac", "ogg"],
+    "text": ["txt", "json", "csv"],
+}
+
+
+def upload_file_presigned(local_path, movie_id, api_url, s3_prefix) -> str:
+    """Upload a file through an API-issued presigned S3 PUT URL and return its public URL"""
+    filename = os.path.basename(local_path)
+    mime_type, _ = mimetypes.guess_type(filename)
+    if not mime_type:
+        mime_type = f"application/{filename.rsplit('.', 1)[-1]}"
+
+    rsp = api_session.get(
+        f"{api_url}/v1/upload/presign",
+        params={
+            "movie_id": movie_id,
+            "filename": filename,
+            "prefix": s3_prefix,
+            "content_type": mime_type,
+        },
+        timeout=API_TIMEOUT,
+    )
+    rsp.raise_for_status()
+    presign = rsp.json()
+
+    # Stream the file from disk; an explicit length keeps requests from falling back
+    # to chunked encoding, which presigned S3 PUTs reject
+    with open(local_path, "rb") as fh:
+        put = api_session.put(
+            presign["url"],
+            data=fh,
+            headers={
+                "Content-Type": mime_type,
+                "Content-Length": str(os.fstat(fh.fileno()).st_size),
+            },
+            timeout=API_TIMEOUT,
+        )
+    put.raise_for_status()
+    return presign["public"]
+
+
+def upload_output_file(local_path, movie_id, api_url, s3_prefix, s3_transfer, s3_bucket) -> str:
+    """Upload a file with the worker's S3 transfer manager, or a presigned URL if s3_transfer is None"""
+    if s3_transfer is None:
+        return upload_file_presigned(local_path, movie_id, api_url, s3_prefix)
+    filename = os.path.basename(local_path)
+    key = f"{s3_prefix}/{movie_id}/{filename}"
+    s3_transfer.upload_file(local_path, s3_bucket, key)
+    return f"https://media.obobo.net/{s3_prefix}/{movie_id}/{filename}"
+
+
+def upload_completed_job(
+    job,
     api_url,
     s3_prefix,
-    s3_client,
+    s3_transfer,
     s3_bucket="obobo-media-production",
-):
-    extensions = {
-        "image": ["png", "jpg", "jpeg"],
-        "video": ["mp4", "webp", "mov", "avi", "mkv", "webm", "gif"],
-        "audio": ["mp3", "wav", "flac", "aac", "ogg"],
-        "text": ["txt", "json", "csv"],
-    }
-    for job in queued_jobs:
-        if not job.completed or not job.output_path:
-            continue
+) -> bool:
+    """
+    Upload the output of a completed job to S3 and report it to the API.
+    If s3_transfer is None, files are uploaded through presigned URLs from the API.
+    Returns True if the job was uploaded and can be removed from the queue.
+    """
+    logger.debug("Uploading completed job %s: %s", job.job['_id'], job.output_path)
+        
+    # Initialize inference dictionary if it doesn't exist
+    if "inference" not in job.job or job.job["inference"] is None:
+        job.job["inference"] = {}
+        
+    # make an if for every possible extension and upload to s3
+    extension = job.output_path.split(".")[-1]
+    extension_type = None
+    for extension_type in UPLOAD_EXTENSIONS.keys():
+        if extension in UPLOAD_EXTENSIONS[extension_type]:
+            generation_type = extension_type
+            break
+    if not extension_type:
+        logger.warning("Unknown file type: %s", extension)
+        return False
 
-        logger.debug("Uploading completed job %s: %s", job.job['_id'], job.output_path)
-            
-        # Initialize inference dictionary if it doesn't exist
-        if "inference" not in job.job or job.job["inference"] is None:
-            job.job["inference"] = {}
-            
-        # make an if for every possible extension and upload to s3
-        extension = job.output_path.split(".")[-1]
-        filename = job.output_path.split("/")[-1]
-        extension_type = None
-        for extension_type in extensions.keys():
-            if extension in extensions[extension_type]:
-                generation_type = extension_type
-                break
-        if not extension_type:
-            logger.warning("Unknown file type: %s", extension)
-            continue
+    display_image = ""
+    display_image_s3_path = ""
+    # Use new create_display_image function for image/video
+    if generation_type in ("image", "video"):
+        display_image = create_display_image(job.output_path, generation_type)
+        if display_image and os.path.exists(display_image):
+            display_image_s3_path = upload_output_file(
+                display_image, job.job["movie_id"], api_url, s3_prefix, s3_transfer, s3_bucket
+            )
+    # For audio/text, display_image remains empty
 
-        display_image = ""
-        display_image_s3_path = ""
-        # Use new create_display_image function for image/video
-        if generation_type in ("image", "video"):
-            display_image = create_display_image(job.output_path, generation_type)
-            if display_image and os.path.exists(display_image):
-                display_image_filename = display_image.split("/")[-1]
-                s3_client.upload_file(
-                    display_image,
-                    s3_bucket,
-                    f"{s3_prefix}/{job.job['movie_id']}/{display_image_filename}",
-                )
-                display_image_s3_path = f"https://media.obobo.net/{s3_prefix}/{job.job['movie_id']}/{display_image_filename}"
-        # For audio/text, display_image remains empty
+    s3_path = upload_output_file(
+        job.output_path, job.job["movie_id"], api_url, s3_prefix, s3_transfer, s3_bucket
+    )
 
-        s3_client.upload_file(
-            job.output_path,
-            s3_bucket,
-            f"{s3_prefix}/{job.job['movie_id']}/{filename}",
-        )
-        s3_path = (
-            f"https://media.obobo.net/{s3_prefix}/{job.job['movie_id']}/{filename}"
-        )
+    inference_output = {
+        "type": generation_type,
+        "url": s3_path,
+        "display_image": display_image_s3_path,
+    }
+    # get the size of the file
+    job.job["inference"]["output_size_in_gb"] = get_file_size_in_gigabytes(
+        job.output_path
+    )
 
-        inference_output = {
-            "type": generation_type,
-            "url": s3_path,
-            "display_image": display_image_s3_path,
-        }
-        # get the size of the file
-        job.job["inference"]["output_size_in_gb"] = get_file_size_in_gigabytes(
-            job.output_path
-        )
+    # update the job in the database with the output
+    api_session.post(f"{api_url}/v1/inference/update_generation_status_to_success/{str(job.job['_id'])}", json={"output": inference_output, "inference": job.job["inference"]}, timeout=API_TIMEOUT)
 
-        # update the job in the database with the output
-        requests.post(f"{api_url}/v1/inference/update_generation_status_to_success/{str(job.job['_id'])}", json={"output": inference_output, "inference": job.job["inference"]})
+    # remove local file
+    # os.remove(job.output_path)
+    return True
 
-        # pop from queued_jobs list
-        queued_jobs.remove(job)
 
-        # remove local file
-        # os.remove(job.output_path)
+def upload_completed_jobs(
+    queued_jobs,
+    api_url,
+    s3_prefix,
+    s3_transfer,
+    s3_bucket="obobo-media-production",
+):
+    for job in list(queued_jobs):
+        if not job.completed or not job.output_path:
+            continue
+        if upload_completed_job(job, api_url, s3_prefix, s3_transfer, s3_bucket):
+            # pop from queued_jobs list
+            queued_jobs.remove(job)
     return queued_jobs
 
 
 def unload_models_and_empty_memory(server: str):
-    requests.post(f"{server}/free", json={"unload_models": True, "free_memory": True})
-
-
-# def upload_completed_jobs(
-#     queued_jobs,
-#     api_url,
-#     s3_prefix,
-#     # s3_client,
-#     # s3_bucket="obobo-media-production",
-# ):
-#     extensions = {
-#         "image": ["png", "jpg", "jpeg"],
-#         "video": ["mp4", "webp", "mov", "avi", "mkv", "webm", "gif"],
-#         "audio": ["mp3", "wav", "flac", "aac", "ogg"],
-#         "text": ["txt", "json", "csv"],
-#     }
-#     for job in queued_jobs:
-#         if not job.completed or not job.output_path:
-#             continue
-
-#         logger.info(f"DEBUG: Uploading completed job {job.job['_id']}: {job.output_path}")
-            
-#         # Initialize inference dictionary if it doesn't exist
-#         if "inference" not in job.job or job.job["inference"] is None:
-#             job.job["inference"] = {}
-            
-#         # make an if for every possible extension and upload to s3
-#         extension = job.output_path.split(".")[-1]
-#         filename = job.output_path.split("/")[-1]
-#         extension_type = None
-#         for extension_type in extensions.keys():
-#             if extension in extensions[extension_type]:
-#                 generation_type = extension_type
-#                 break
-#         if not extension_type:
-#             logger.info(f"Unknown file type: {extension}")
-#             continue
-
-#         display_image = ""
-#         display_image_s3_path = ""
-#         # Use new create_display_image function for image/video
-#         if generation_type in ("image", "video"):
-#             display_image = create_display_image(job.output_path, generation_type)
-
-#         # --- always use presigned S3 PUT (no CloudFront size limits) ---
-#         mime_type, _ = mimetypes.guess_type(filename)
-#         if not mime_type:
-#             mime_type = f"application/{extension}"
-
-#         rsp = requests.get(
-#             f"{api_url}/v1/upload/presign",
-#             params={
-#                 "movie_id": job.job["movie_id"],
-#                 "filename": filename,
-#                 "prefix":  s3_prefix,
-#                 "content_type": mime_type,
-#             },
-#         )
-#         presign = rsp.json()
-
-#         with open(job.output_path, "rb") as fh:
-#             put = requests.put(
-#                 presign["url"],
-#                 data=fh,
-#                 headers={"Content-Type": mime_type},
-#             )
-#         if put.status_code not in (200, 204):
-#             logger.info(f"Failed presigned upload: {put.text}")
-#             continue
-
-#         s3_path = presign["public"]
-
-#         # Upload display image if exists
-#         if display_image and os.path.exists(display_image):
-#             thumb_name = os.path.basename(display_image)
-#             mime_type, _ = mimetypes.guess_type(thumb_name)
-#             if not mime_type:
-#                 mime_type = "image/webp"
-
-#             rsp = requests.get(
-#                 f"{api_url}/v1/upload/presign",
-#                 params={
-#                     "movie_id": job.job["movie_id"],
-#                     "filename": thumb_name,
-#                     "prefix": s3_prefix,
-#                     "content_type": mime_type,
-#                 },
-#             )
-#             presign_thumb = rsp.json()
-
-#             with open(display_image, "rb") as fh:
-#                 requests.put(
-#                     presign_thumb["url"],
-#                     data=fh,
-#                     headers={"Content-Type": mime_type},
-#                 )
-
-#             display_image_s3_path = presign_thumb["public"]
-
-#         inference_output = {
-#             "type": generation_type,
-#             "url": s3_path,
-#             "display_image": display_image_s3_path,
-#         }
-#         # get the size of the file
-#         job.job["inference"]["output_size_in_gb"] = get_file_size_in_gigabytes(
-#             job.output_path
-#         )
-
-#         # update the job in the database with the output
-#         requests.post(
-#             f"{api_url}/v1/inference/update_generation_status_to_success/{str(job.job['_id'])}",
-#             json={"output": inference_output, "inference": job.job["inference"]}
-#         )
-
-#         # pop from queued_jobs list
-#         queued_jobs.remove(job)
-
-#         # remove local file
-#         # os.remove(job.output_path)
-#     return queued_jobs
-
-
-# def unload_models_and_empty_memory(server: str):
-#     requests.post(f"{server}/free", json={"unload_models": True, "free_memory": True})
+    comfyui_session.post(f"{server}/free", json={"unload_models": True, "free_memory": True}, timeout=COMFYUI_TIMEOUT)
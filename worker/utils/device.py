@@ -1,10 +1,90 @@
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Optional
+
 import GPUtil
-from pydantic import BaseModel
+import psutil
+
+# NVML answers in-process; GPUtil forks nvidia-smi on every call
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+# Without NVML, utilization is re-read through GPUtil at most this often
+GPUTIL_UTILIZATION_TTL = 60
+_gputil_utilization = ([], 0.0)
 
-class GPU(BaseModel):
+@dataclass(slots=True)
+class GPU:
     name: str
     capacity_in_gb: float
 
+    def model_dump(self):
+        return asdict(self)
+
+@lru_cache(maxsize=1)
+def nvml_handles():
+    """NVML device handles, or None if NVML is not available"""
+    if pynvml is None:
+        return None
+    try:
+        pynvml.nvmlInit()
+        return [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+    except pynvml.NVMLError:
+        return None
+
+@lru_cache(maxsize=1)
 def get_gpu_info():
+    """GPUs visible to this process; topology doesn't change, so it is probed once"""
+    handles = nvml_handles()
+    if handles is not None:
+        return [
+            GPU(
+                name=_decode(pynvml.nvmlDeviceGetName(h)),
+                capacity_in_gb=pynvml.nvmlDeviceGetMemoryInfo(h).total / 1024 ** 3,
+            )
+            for h in handles
+        ]
     gpus = GPUtil.getGPUs()
     return [GPU(name=gpu.name, capacity_in_gb=gpu.memoryTotal / 1024) for gpu in gpus]
+
+def get_gpu_utilization():
+    """Current load of each GPU as a percentage; up to GPUTIL_UTILIZATION_TTL seconds old without NVML"""
+    global _gputil_utilization
+    handles = nvml_handles()
+    if handles is not None:
+        return [float(pynvml.nvmlDeviceGetUtilizationRates(h).gpu) for h in handles]
+    utilization, read_at = _gputil_utilization
+    if time.monotonic() - read_at >= GPUTIL_UTILIZATION_TTL:
+        utilization = [round(gpu.load * 100, 1) for gpu in GPUtil.getGPUs()]
+        _gputil_utilization = (utilization, time.monotonic())
+    return utilization
+
+def _decode(name):
+    # Older pynvml releases return bytes
+    return name.decode() if isinstance(name, bytes) else name
+
+def get_cached_gpu_info(instance_id: Optional[str] = None):
+    """Return GPU info, reusing the probe result cached on disk since the last boot"""
+    cache_path = f"/tmp/gpu_info_{instance_id or 'local'}.json"
+    try:
+        # GPUs don't change within a boot, so the cache is valid if written after it
+        if os.path.getmtime(cache_path) > psutil.boot_time():
+            with open(cache_path) as f:
+                return [GPU(**d) for d in json.load(f)]
+    except (OSError, ValueError, TypeError):
+        pass
+
+    gpus = get_gpu_info()
+    try:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([g.model_dump() for g in gpus], f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return gpus
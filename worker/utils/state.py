@@ -0,0 +1,74 @@
+import orjson
+import os
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobStateStore:
+    """
+    Durable per-job state so a restarted worker can resume an interrupted batch.
+    Jobs move through queued -> submitted -> completed and are removed once uploaded.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    job TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    prompt_id TEXT,
+                    output_path TEXT,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def add_queued(self, jobs):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO jobs (job_id, job, status, updated_at) VALUES (?, ?, 'queued', ?)",
+                [(str(job["_id"]), orjson.dumps(job, default=str), time.time()) for job in jobs],
+            )
+
+    def mark_submitted(self, queued_jobs):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE jobs SET status = 'submitted', prompt_id = ?, updated_at = ? WHERE job_id = ?",
+                [(queued_job.prompt_id, time.time(), str(queued_job.job["_id"])) for queued_job in queued_jobs],
+            )
+
+    def mark_completed(self, queued_job):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'completed', output_path = ?, job = ?, updated_at = ? WHERE job_id = ?",
+                (
+                    queued_job.output_path,
+                    orjson.dumps(queued_job.job, default=str),
+                    time.time(),
+                    str(queued_job.job["_id"]),
+                ),
+            )
+
+    def discard(self, job_ids):
+        """Forget jobs that were uploaded or reported as failed"""
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM jobs WHERE job_id = ?", [(str(job_id),) for job_id in job_ids]
+            )
+
+    def pending(self):
+        """Return (job, status, prompt_id, output_path) for every job not yet uploaded"""
+        rows = self.conn.execute(
+            "SELECT job, status, prompt_id, output_path FROM jobs ORDER BY updated_at"
+        ).fetchall()
+        return [(orjson.loads(job), status, prompt_id, output_path) for job, status, prompt_id, output_path in rows]
+
+    def close(self):
+        self.conn.close()